@@ -1,15 +1,81 @@
 import json
+import socket
 import sqlite3
+import threading
 import time
-from typing import TYPE_CHECKING
+import zlib
+from contextlib import closing
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, cast
 from unittest.mock import MagicMock, Mock, patch
 
 import pytest
 
-from tlt.jira_cache_updater import ConnectionSupplier, JiraCacheUpdater
+from tlt.jira_cache_updater import (
+    DEFAULT_RETRY_AFTER_SECONDS,
+    JSON_ZDICT_SAMPLE_ISSUES,
+    MAX_RATE_LIMITED_RETRIES,
+    OPTIMIZE_INTERVAL_SECONDS,
+    WAL_CHECKPOINT_MIN_ISSUES,
+    ConnectionSupplier,
+    Issue,
+    JiraCacheUpdater,
+    _retry_after_seconds,
+    create_file_db_connection_supplier,
+    decode_issue_json,
+    read_issue_json_zdict,
+)
 
 if TYPE_CHECKING:
-    from tlt.raw_issue_dict import RawJiraIssueDict
+    from tlt.raw_issue_dict import (
+        AssigneeDict,
+        RawJiraIssueDict,
+        TimeTrackingDict,
+        WorkLogsDict,
+    )
+
+
+def _raw_issue(key: str, updated: str) -> "RawJiraIssueDict":
+    return cast(
+        "RawJiraIssueDict", {"key": key, "fields": {"updated": updated}}
+    )
+
+
+def _mock_response(body: dict) -> Mock:
+    response = Mock()
+    response.status_code = 200
+    response.headers = {}
+    response.content = json.dumps(body).encode()
+    return response
+
+
+def _update_issues(
+    updater: JiraCacheUpdater, raw_issues: "list[RawJiraIssueDict]"
+) -> int:
+    with updater._conn as conn:
+        return updater._update_issues(conn.cursor(), raw_issues)
+
+
+def _run_empty_check(
+    updater: JiraCacheUpdater, mock_session: MagicMock, check_time: float
+) -> None:
+    mock_session.post.return_value = _mock_response(
+        {"issues": [], "isLast": True}
+    )
+    with patch("tlt.jira_cache_updater.time.time", return_value=check_time):
+        updater.run_check()
+
+
+def _make_updater(
+    connection_supplier: ConnectionSupplier, **kwargs: Any
+) -> JiraCacheUpdater:
+    return JiraCacheUpdater(
+        jira_server_base="https://jira.example.com",
+        jira_token="test_token",  # noqa: S106
+        jql="project = TEST",
+        connection_supplier=connection_supplier,
+        **kwargs,
+    )
 
 
 @pytest.fixture
@@ -36,13 +102,8 @@ def mock_session():
 def jira_cache_updater(
     in_memory_db: ConnectionSupplier, mock_session: MagicMock
 ):
-    updater = JiraCacheUpdater(
-        jira_server_base="https://jira.example.com",
-        jira_token="test_token",  # noqa: S106
-        jql="project = TEST",
-        connection_supplier=in_memory_db,
-        seconds_per_check=1,
-        requests_per_second=1,
+    updater = _make_updater(
+        in_memory_db, seconds_per_check=1, requests_per_second=1
     )
     updater.session = mock_session
     return updater
@@ -67,16 +128,104 @@ def test_init_db(
         )
         assert cursor.fetchone() is not None
 
+        # Check if the last_updated index exists
+        cursor.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type='index' AND name='idx_issues_last_updated'"
+        )
+        assert cursor.fetchone() is not None
+
+        # Check if the user_key index exists
+        cursor.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type='index' AND name='idx_seconds_spent_user'"
+        )
+        assert cursor.fetchone() is not None
+
+
+@pytest.mark.parametrize("batch_size", [0, -1])
+def test_init_rejects_batch_size_below_one(
+    in_memory_db: ConnectionSupplier, batch_size: int
+):
+    with pytest.raises(ValueError, match="batch_size"):
+        _make_updater(in_memory_db, batch_size=batch_size)
+
+
+def test_session_sends_auth_header():
+    with patch("tlt.jira_cache_updater.LimiterSession") as mock:
+        mock.return_value.headers = {}
+        updater = _make_updater(lambda: sqlite3.connect(":memory:"))
+    assert updater.session.headers["Authorization"] == "Bearer test_token"
+    assert not hasattr(updater, "auth")
+
 
-def test_get_set_last_check_time(jira_cache_updater: JiraCacheUpdater):
+def test_session_pools_a_connection_per_worker():
+    with patch("tlt.jira_cache_updater.LimiterSession") as mock:
+        updater = _make_updater(
+            lambda: sqlite3.connect(":memory:"), requests_per_second=10
+        )
+    adapter = mock.return_value.mount.call_args.args[1]
+    assert updater.max_workers == 40
+    assert adapter._pool_maxsize == updater.max_workers
+    socket_options = adapter.poolmanager.connection_pool_kw["socket_options"]
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in socket_options
+
+
+def test_context_manager_closes_connection(
+    mock_session: MagicMock,  # noqa: ARG001
+):
+    with _make_updater(lambda: closing(sqlite3.connect(":memory:"))) as updater:
+        updater._conn.execute("SELECT 1")
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        updater._conn.execute("SELECT 1")
+
+
+def test_get_set_last_check_time(
+    jira_cache_updater: JiraCacheUpdater, mock_session: MagicMock
+):
     # Test setting and getting last check time
     current_time = time.time()
-    jira_cache_updater._set_last_check_time(current_time)
+    _run_empty_check(jira_cache_updater, mock_session, current_time)
 
     retrieved_time = jira_cache_updater._get_last_check_time()
     assert retrieved_time == current_time
 
 
+def test_last_check_time_is_single_row_and_reloaded(
+    jira_cache_updater: JiraCacheUpdater,
+    in_memory_db: ConnectionSupplier,
+    mock_session: MagicMock,
+):
+    _run_empty_check(jira_cache_updater, mock_session, 100.0)
+    _run_empty_check(jira_cache_updater, mock_session, 200.0)
+
+    with in_memory_db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM checks").fetchone()[0] == 1
+
+    reloaded = _make_updater(in_memory_db)
+    assert reloaded._get_last_check_time() == 200.0
+
+
+def test_last_check_time_reads_legacy_checks_table(
+    in_memory_db: ConnectionSupplier,
+    mock_session: MagicMock,  # noqa: ARG001
+):
+    # Older databases kept one row per check
+    with in_memory_db() as conn:
+        conn.execute(
+            "CREATE TABLE checks ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, last_check_time REAL)"
+        )
+        conn.executemany(
+            "INSERT INTO checks (last_check_time) VALUES (?)",
+            [(100.0,), (300.0,), (200.0,)],
+        )
+
+    updater = _make_updater(in_memory_db)
+    assert updater._get_last_check_time() == 300.0
+
+
 def test_update_issue(
     jira_cache_updater: JiraCacheUpdater, in_memory_db: ConnectionSupplier
 ):
@@ -116,7 +265,7 @@ def test_update_issue(
         "self": "dummy_self",
     }
 
-    jira_cache_updater._update_issue(test_issue)
+    assert _update_issues(jira_cache_updater, [test_issue]) == 1
 
     with in_memory_db() as conn:
         cursor = conn.cursor()
@@ -125,29 +274,310 @@ def test_update_issue(
 
         assert result is not None
         assert result[0] == "TEST-1"
-        assert json.loads(result[1]) == test_issue
-        assert result[2] == "2023-01-01T12:00:00.000+0000"
+        zdict = read_issue_json_zdict(conn)
+        assert decode_issue_json(result[1], zdict) == test_issue
+        assert result[2] is None
+        assert result[3] == "2023-01-01T12:00:00.000+0000"
+
+
+def test_update_issues_skips_unchanged(
+    jira_cache_updater: JiraCacheUpdater, in_memory_db: ConnectionSupplier
+):
+    unchanged = _raw_issue("TEST-1", "2023-01-01")
+    changed = _raw_issue("TEST-2", "2023-01-01")
+    _update_issues(jira_cache_updater, [unchanged, changed])
+
+    changed = _raw_issue("TEST-2", "2023-01-02")
+    with patch(
+        "tlt.jira_cache_updater.Issue.from_raw", wraps=Issue.from_raw
+    ) as from_raw:
+        assert _update_issues(jira_cache_updater, [unchanged, changed]) == 1
+
+    from_raw.assert_called_once_with(
+        changed, jira_cache_updater._zdict, include_json=True
+    )
+    with in_memory_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT key, last_updated FROM issues ORDER BY key")
+        assert cursor.fetchall() == [
+            ("TEST-1", "2023-01-01"),
+            ("TEST-2", "2023-01-02"),
+        ]
+
+
+def test_update_issues_upserts_existing_rows(
+    jira_cache_updater: JiraCacheUpdater, in_memory_db: ConnectionSupplier
+):
+    # Writing the same issue twice goes through the ON CONFLICT branches of
+    # both upserts, so a syntax error in either cannot go unnoticed
+    issue = _raw_issue("TEST-1", "2023-01-01")
+    issue["fields"]["worklog"] = cast(
+        "WorkLogsDict",
+        {"worklogs": [{"author": {"key": "alice"}, "timeSpentSeconds": 60}]},
+    )
+    _update_issues(jira_cache_updater, [issue])
+
+    issue = _raw_issue("TEST-1", "2023-01-02")
+    issue["fields"]["assignee"] = cast("AssigneeDict", {"name": "alice"})
+    issue["fields"]["timetracking"] = cast(
+        "TimeTrackingDict", {"originalEstimateSeconds": 3600}
+    )
+    issue["fields"]["worklog"] = cast(
+        "WorkLogsDict",
+        {"worklogs": [{"author": {"key": "alice"}, "timeSpentSeconds": 90}]},
+    )
+    _update_issues(jira_cache_updater, [issue])
+
+    with in_memory_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT key, json_data, assignee_name, last_updated, "
+            "original_seconds_estimated FROM issues"
+        )
+        rows = cursor.fetchall()
+        assert len(rows) == 1
+        key, json_data, assignee_name, last_updated, estimate = rows[0]
+        assert (key, assignee_name, last_updated, estimate) == (
+            "TEST-1",
+            "alice",
+            "2023-01-02",
+            3600,
+        )
+        zdict = read_issue_json_zdict(conn)
+        assert decode_issue_json(json_data, zdict) == issue
+        cursor.execute("SELECT issue_key, user_key, seconds FROM seconds_spent")
+        assert cursor.fetchall() == [("TEST-1", "alice", 90)]
+
+
+def test_update_issues_leaves_unchanged_rows_alone(
+    jira_cache_updater: JiraCacheUpdater,
+):
+    work_logs = cast(
+        "WorkLogsDict",
+        {
+            "worklogs": [
+                {"author": {"key": "alice"}, "timeSpentSeconds": 60},
+                {"author": {"key": "bob"}, "timeSpentSeconds": 30},
+            ]
+        },
+    )
+    issue = _raw_issue("TEST-1", "2023-01-01")
+    issue["fields"]["worklog"] = work_logs
+    _update_issues(jira_cache_updater, [issue])
+
+    # Only the issue row changes: neither user's time spent does
+    conn = jira_cache_updater._conn
+    changes_before = conn.total_changes
+    issue = _raw_issue("TEST-1", "2023-01-02")
+    issue["fields"]["worklog"] = work_logs
+    _update_issues(jira_cache_updater, [issue])
+    assert conn.total_changes - changes_before == 1
+
+    # An issue returned twice in the same batch is only written once
+    changes_before = conn.total_changes
+    issue = _raw_issue("TEST-1", "2023-01-03")
+    issue["fields"]["worklog"] = work_logs
+    _update_issues(jira_cache_updater, [issue, issue])
+    assert conn.total_changes - changes_before == 1
+
+
+def test_update_issues_writes_seconds_spent(
+    jira_cache_updater: JiraCacheUpdater, in_memory_db: ConnectionSupplier
+):
+    def work_log(author: str, seconds: int) -> dict:
+        return {"author": {"key": author}, "timeSpentSeconds": seconds}
+
+    issues = [
+        _raw_issue("TEST-1", "2023-01-01"),
+        _raw_issue("TEST-2", "2023-01-01"),
+    ]
+    issues[0]["fields"]["worklog"] = cast(
+        "WorkLogsDict",
+        {"worklogs": [work_log("alice", 60), work_log("bob", 30)]},
+    )
+    issues[1]["fields"]["worklog"] = cast(
+        "WorkLogsDict",
+        {"worklogs": [work_log("alice", 10), work_log("alice", 5)]},
+    )
+    _update_issues(jira_cache_updater, issues)
+
+    with in_memory_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT issue_key, user_key, seconds FROM seconds_spent "
+            "ORDER BY issue_key, user_key"
+        )
+        assert cursor.fetchall() == [
+            ("TEST-1", "alice", 60),
+            ("TEST-1", "bob", 30),
+            ("TEST-2", "alice", 15),
+        ]
+
+
+def test_update_issues_without_full_json(
+    in_memory_db: ConnectionSupplier, mock_session: MagicMock
+):
+    updater = _make_updater(in_memory_db, include_full_json=False)
+    mock_session.post.return_value = _mock_response(
+        {"issues": [_raw_issue("TEST-1", "2023-01-01")], "isLast": True}
+    )
+    list(updater._download_issues("project = TEST"))
+    payload = json.loads(mock_session.post.call_args.kwargs["data"])
+    assert set(payload["fields"]) == {
+        "updated",
+        "assignee",
+        "timetracking",
+        "worklog",
+    }
+
+    _update_issues(updater, [_raw_issue("TEST-1", "2023-01-01")])
+
+    with in_memory_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT json_data, last_updated FROM issues")
+        assert cursor.fetchall() == [(None, "2023-01-01")]
+        assert read_issue_json_zdict(conn) is None
+
+
+def test_full_json_is_backfilled_after_running_without_it(
+    in_memory_db: ConnectionSupplier, mock_session: MagicMock
+):
+    issue = _raw_issue("TEST-1", "2023-01-01")
+    # TEST-2 no longer matches the JQL when the JSON is backfilled
+    moved = _raw_issue("TEST-2", "2023-01-01")
+    without_json = _make_updater(in_memory_db, include_full_json=False)
+    _update_issues(without_json, [issue, moved])
+    _run_empty_check(without_json, mock_session, 1000.0)
+
+    with_json = _make_updater(in_memory_db, include_full_json=True)
+    with_json.session = mock_session
+    # The unchanged issue is only fetched again by a full check
+    assert with_json._get_last_check_time() is None
+    mock_session.post.return_value = _mock_response(
+        {"issues": [issue], "isLast": True}
+    )
+    with patch("tlt.jira_cache_updater.time.time", return_value=2000.0):
+        assert with_json.run_check() == 1
+
+    with in_memory_db() as conn:
+        rows = conn.execute(
+            "SELECT key, json_data FROM issues ORDER BY key"
+        ).fetchall()
+        zdict = read_issue_json_zdict(conn)
+    assert rows[0][0] == "TEST-1"
+    assert decode_issue_json(rows[0][1], zdict) == issue
+    assert rows[1] == ("TEST-2", None)
+
+    # Once backfilled, a restart checks incrementally again even though
+    # TEST-2 never gets its JSON
+    restarted = _make_updater(in_memory_db, include_full_json=True)
+    assert restarted._get_last_check_time() == 2000.0
+
+
+def test_decode_issue_json_reads_legacy_text():
+    assert decode_issue_json('{"key": "TEST-1"}') == {"key": "TEST-1"}
+
+
+def test_init_db_compresses_legacy_text_rows(
+    in_memory_db: ConnectionSupplier,
+    mock_session: MagicMock,  # noqa: ARG001
+):
+    # Older versions cached the JSON as text, enough of it to sample the
+    # dictionary from
+    legacy = [
+        {"key": f"TEST-{n}", "fields": {"updated": "2023-01-01"}}
+        for n in range(JSON_ZDICT_SAMPLE_ISSUES)
+    ]
+    with in_memory_db() as conn:
+        conn.execute(
+            "CREATE TABLE issues (key TEXT PRIMARY KEY, json_data TEXT, "
+            "assignee_name TEXT, last_updated TEXT, "
+            "original_seconds_estimated INTEGER, "
+            "cache_time TEXT NOT NULL DEFAULT current_timestamp)"
+        )
+        conn.executemany(
+            "INSERT INTO issues (key, json_data, last_updated) "
+            "VALUES (?, ?, ?)",
+            [
+                (issue["key"], json.dumps(issue), "2023-01-01")
+                for issue in legacy
+            ],
+        )
+
+    _make_updater(in_memory_db)
+
+    with in_memory_db() as conn:
+        zdict = read_issue_json_zdict(conn)
+        assert zdict is not None
+        rows = conn.execute(
+            "SELECT typeof(json_data), json_data FROM issues ORDER BY rowid"
+        ).fetchall()
+    assert [json_type for json_type, _ in rows] == ["blob"] * len(legacy)
+    assert [
+        decode_issue_json(json_data, zdict) for _, json_data in rows
+    ] == legacy
+
+
+def test_decode_issue_json_reads_rows_without_zdict():
+    json_data = zlib.compress(b'{"key": "TEST-1"}')
+    assert decode_issue_json(json_data, b'{"key": "TEST-2"}') == {
+        "key": "TEST-1"
+    }
+
+
+def test_update_issues_compresses_with_stored_zdict(
+    jira_cache_updater: JiraCacheUpdater, in_memory_db: ConnectionSupplier
+):
+    issues = [
+        _raw_issue(f"TEST-{n}", "2023-01-01")
+        for n in range(JSON_ZDICT_SAMPLE_ISSUES + 1)
+    ]
+    for issue in issues:
+        issue["fields"]["description"] = "A description shared by the issues"
+
+    # One issue short of the sample: compressed without a dictionary
+    _update_issues(jira_cache_updater, issues[: JSON_ZDICT_SAMPLE_ISSUES - 1])
+    assert jira_cache_updater._zdict is None
+
+    # The sample is completed across pages
+    _update_issues(jira_cache_updater, issues[JSON_ZDICT_SAMPLE_ISSUES - 1 :])
+    zdict = jira_cache_updater._zdict
+    assert zdict is not None
+
+    # The dictionary is chosen once, stored, and used for later issues
+    with in_memory_db() as conn:
+        assert read_issue_json_zdict(conn) == zdict
+        rows = conn.execute(
+            "SELECT key, json_data FROM issues ORDER BY rowid"
+        ).fetchall()
+    for issue, (key, json_data) in zip(issues, rows, strict=True):
+        assert key == issue["key"]
+        assert decode_issue_json(json_data, zdict) == issue
+    zlib.decompress(rows[0][1])
+    with pytest.raises(zlib.error):
+        zlib.decompress(rows[-1][1])
 
 
 def test_run_check(
     jira_cache_updater: JiraCacheUpdater, mock_session: MagicMock
 ):
     # Mock the API response
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "issues": [
-            {
-                "key": "TEST-1",
-                "fields": {"updated": "2023-01-01T12:00:00.000+0000"},
-                "summary": "Test issue",
-            }
-        ],
-        "isLast": True,
-    }
+    mock_response = _mock_response(
+        {
+            "issues": [
+                {
+                    "key": "TEST-1",
+                    "fields": {"updated": "2023-01-01T12:00:00.000+0000"},
+                    "summary": "Test issue",
+                }
+            ],
+            "isLast": True,
+        }
+    )
     mock_session.post.return_value = mock_response
 
     # Run the check
-    jira_cache_updater.run_check()
+    assert jira_cache_updater.run_check() == 1
 
     # Verify that the issue was updated in the database
     with jira_cache_updater.connection_supplier() as conn:
@@ -157,21 +587,135 @@ def test_run_check(
 
         assert result is not None
         assert result[0] == "TEST-1"
-        assert "Test issue" in result[1]
+        issue = decode_issue_json(result[1], read_issue_json_zdict(conn))
+        assert cast(dict, issue)["summary"] == "Test issue"
+
+        # The first check is a backfill, so it gathers planner statistics
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE name='sqlite_stat1'"
+        )
+        assert cursor.fetchone() is not None
+
+
+def test_run_check_limits_jql_to_time_since_last_check(
+    jira_cache_updater: JiraCacheUpdater, mock_session: MagicMock
+):
+    def sent_jql() -> str:
+        return json.loads(mock_session.post.call_args.kwargs["data"])["jql"]
+
+    _run_empty_check(jira_cache_updater, mock_session, 1000.0)
+    assert sent_jql() == "project = TEST"
+
+    # 150 seconds later: round up to 3 minutes, plus one. The checks take
+    # no time, so the window is not widened.
+    _run_empty_check(jira_cache_updater, mock_session, 1150.0)
+    assert sent_jql() == "updated >= -4m AND (project = TEST)"
+
+    # The clock was set back: still ask for the last minute
+    _run_empty_check(jira_cache_updater, mock_session, 300.0)
+    assert sent_jql() == "updated >= -1m AND (project = TEST)"
+
+
+def test_run_check_keeps_last_check_time_when_it_outlasts_jql_window(
+    jira_cache_updater: JiraCacheUpdater,
+    in_memory_db: ConnectionSupplier,
+    mock_session: MagicMock,
+):
+    _run_empty_check(jira_cache_updater, mock_session, 1000.0)
+    pages = [
+        _mock_response(
+            {
+                "issues": [_raw_issue(f"TEST-{n}", "2023-01-01")],
+                "total": 2,
+                "isLast": n == 2,
+            }
+        )
+        for n in (1, 2)
+    ]
+    mock_session.post.side_effect = pages
+    jira_cache_updater.batch_size = 1
+
+    def now() -> float:
+        # The clock passes the end of the 4 minute window while the pages
+        # download
+        if mock_session.post.call_count < 2:
+            return 1150.0
+        return 1150.0 + 5 * 60
+
+    with patch("tlt.jira_cache_updater.time.time", side_effect=now):
+        assert jira_cache_updater.run_check() == 2
+
+    # Both pages are kept, but the next check covers their window again
+    with in_memory_db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM issues").fetchone()[0] == 2
+        assert conn.execute(
+            "SELECT last_check_time FROM checks"
+        ).fetchone() == (1000.0,)
+    assert jira_cache_updater._get_last_check_time() == 1000.0
+
+    def sent_jql() -> str:
+        return json.loads(mock_session.post.call_args.kwargs["data"])["jql"]
+
+    # Widened by the 5 minutes the last check took
+    mock_session.post.side_effect = None
+    _run_empty_check(jira_cache_updater, mock_session, 1500.0)
+    assert sent_jql() == "updated >= -15m AND (project = TEST)"
+    assert jira_cache_updater._get_last_check_time() == 1500.0
+
+    # That check was quick, so the one after is not widened
+    _run_empty_check(jira_cache_updater, mock_session, 1510.0)
+    assert sent_jql() == "updated >= -2m AND (project = TEST)"
+
+
+def test_run_check_is_one_transaction(
+    jira_cache_updater: JiraCacheUpdater,
+    in_memory_db: ConnectionSupplier,
+    mock_session: MagicMock,
+):
+    # The check fails after its first page has been written, so neither that
+    # page nor the check time may be committed
+    first_page = _mock_response(
+        {
+            "issues": [_raw_issue("TEST-1", "2023-01-01")],
+            "total": 2,
+            "isLast": False,
+        }
+    )
+    mock_session.post.side_effect = [first_page, RuntimeError("boom")]
+    jira_cache_updater.batch_size = 1
+    jira_cache_updater.max_workers = 1
+
+    # The first page is enough to sample the dictionary from
+    with patch(
+        "tlt.jira_cache_updater.JSON_ZDICT_SAMPLE_ISSUES", 1
+    ), pytest.raises(RuntimeError):
+        jira_cache_updater.run_check()
+
+    with in_memory_db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM issues").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM checks").fetchone()[0] == 0
+        assert read_issue_json_zdict(conn) is None
+    assert jira_cache_updater._get_last_check_time() is None
+
+    # The next check does not use the dictionary that was rolled back
+    mock_session.post.side_effect = None
+    _run_empty_check(jira_cache_updater, mock_session, 1000.0)
+    assert jira_cache_updater._zdict is None
 
 
 def test_download_issues(
     jira_cache_updater: JiraCacheUpdater, mock_session: MagicMock
 ):
     # Mock the API response
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "issues": [
-            {"key": "TEST-1", "fields": {"summary": "Issue 1"}},
-            {"key": "TEST-2", "fields": {"summary": "Issue 2"}},
-        ],
-        "isLast": True,
-    }
+    mock_response = _mock_response(
+        {
+            "issues": [
+                {"key": "TEST-1", "fields": {"summary": "Issue 1"}},
+                {"key": "TEST-2", "fields": {"summary": "Issue 2"}},
+            ],
+            "isLast": True,
+        }
+    )
     mock_session.post.return_value = mock_response
 
     issues = list(jira_cache_updater._download_issues("project = TEST"))
@@ -180,19 +724,346 @@ def test_download_issues(
     assert issues[0]["key"] == "TEST-1"
     assert issues[1]["key"] == "TEST-2"
 
+    payload = json.loads(mock_session.post.call_args.kwargs["data"])
+    assert set(payload["fields"]) == {
+        "*all",
+        "-comment",
+        "-watches",
+        "-votes",
+        "-attachment",
+    }
+    assert payload["expand"] == ["names"]
+
+
+def test_download_issues_downshifts_batch_size(
+    jira_cache_updater: JiraCacheUpdater, mock_session: MagicMock
+):
+    # The server caps pages at 2 issues even though 3 were requested
+    first_page = _mock_response(
+        {
+            "issues": [{"key": "TEST-1"}, {"key": "TEST-2"}],
+            "total": 3,
+        }
+    )
+    second_page = _mock_response({"issues": [{"key": "TEST-3"}], "total": 3})
+    mock_session.post.side_effect = [first_page, second_page]
+    jira_cache_updater.batch_size = 3
+
+    issues = list(jira_cache_updater._download_issues("project = TEST"))
+
+    assert [i["key"] for i in issues] == ["TEST-1", "TEST-2", "TEST-3"]
+    assert mock_session.post.call_count == 2
+    second_payload = json.loads(mock_session.post.call_args.kwargs["data"])
+    assert second_payload["startAt"] == 2
+    assert second_payload["maxResults"] == 2
+    assert jira_cache_updater.batch_size == 2
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_download_issues_fetches_remaining_pages_concurrently(
+    jira_cache_updater: JiraCacheUpdater,
+    mock_session: MagicMock,
+    max_workers: int,
+):
+    def post(_url, data):
+        start_at = json.loads(data)["startAt"]
+        return _mock_response(
+            {
+                "issues": [
+                    {"key": f"TEST-{i}"}
+                    for i in range(start_at, min(start_at + 2, 5))
+                ],
+                "total": 5,
+            }
+        )
+
+    mock_session.post.side_effect = post
+    jira_cache_updater.batch_size = 2
+    jira_cache_updater.max_workers = max_workers
+
+    issues = list(jira_cache_updater._download_issues("project = TEST"))
+
+    assert sorted(i["key"] for i in issues) == [f"TEST-{i}" for i in range(5)]
+    start_ats = sorted(
+        json.loads(c.kwargs["data"])["startAt"]
+        for c in mock_session.post.call_args_list
+    )
+    assert start_ats == [0, 2, 4]
+
+
+@pytest.mark.parametrize("with_total", [True, False])
+def test_download_issues_prefetches_while_first_page_is_consumed(
+    jira_cache_updater: JiraCacheUpdater,
+    mock_session: MagicMock,
+    with_total: bool,  # noqa: FBT001
+):
+    second_page_requested = threading.Event()
+
+    def post(_url, data):
+        start_at = json.loads(data)["startAt"]
+        if start_at > 0:
+            second_page_requested.set()
+        body: dict = {
+            "issues": [{"key": f"TEST-{start_at}"}],
+            "isLast": start_at > 0,
+        }
+        if with_total:
+            body["total"] = 2
+        return _mock_response(body)
+
+    mock_session.post.side_effect = post
+    jira_cache_updater.batch_size = 1
+
+    issues = jira_cache_updater._download_issues("project = TEST")
+    assert next(issues)["key"] == "TEST-0"
+    # The consumer has not asked for more yet, but the next page is on its
+    # way
+    assert second_page_requested.wait(timeout=5)
+    assert [i["key"] for i in issues] == ["TEST-1"]
+
+
+def test_download_issues_retries_after_rate_limit(
+    jira_cache_updater: JiraCacheUpdater, mock_session: MagicMock
+):
+    rate_limited = _mock_response({})
+    rate_limited.status_code = 429
+    rate_limited.headers = {"Retry-After": "2"}
+    ok = _mock_response(
+        {"issues": [{"key": "TEST-1"}], "isLast": True},
+    )
+    ok.headers = {
+        "x-ratelimit-interval-seconds": "10",
+        "x-ratelimit-fillrate": "2",
+    }
+    mock_session.post.side_effect = [rate_limited, ok]
+
+    with patch("tlt.jira_cache_updater.time.sleep") as sleep:
+        issues = list(jira_cache_updater._download_issues("project = TEST"))
+
+    assert [i["key"] for i in issues] == ["TEST-1"]
+    sleep.assert_called_once_with(2.0)
+    assert jira_cache_updater._server_min_interval == 5.0
+
+
+def test_download_issues_notes_rate_limit_of_last_retry(
+    jira_cache_updater: JiraCacheUpdater, mock_session: MagicMock
+):
+    rate_limited = _mock_response({})
+    rate_limited.status_code = 429
+    ok = _mock_response({"issues": [{"key": "TEST-1"}], "isLast": True})
+    ok.headers = {
+        "x-ratelimit-interval-seconds": "10",
+        "x-ratelimit-fillrate": "2",
+    }
+    mock_session.post.side_effect = [
+        *[rate_limited] * MAX_RATE_LIMITED_RETRIES,
+        ok,
+    ]
+
+    with patch("tlt.jira_cache_updater.time.sleep") as sleep:
+        issues = list(jira_cache_updater._download_issues("project = TEST"))
+
+    assert [i["key"] for i in issues] == ["TEST-1"]
+    assert sleep.call_count == MAX_RATE_LIMITED_RETRIES
+    assert jira_cache_updater._server_min_interval == 5.0
+
+
+@pytest.mark.parametrize(
+    ("retry_after", "expected"),
+    [
+        (None, DEFAULT_RETRY_AFTER_SECONDS),
+        ("3", 3.0),
+        ("-1", 0.0),
+        ("not a date", DEFAULT_RETRY_AFTER_SECONDS),
+        ("Thu, 01 Jan 1970 00:00:40 GMT", 30.0),
+    ],
+)
+def test_retry_after_seconds(retry_after: str | None, expected: float):
+    with patch("tlt.jira_cache_updater.time.time", return_value=10.0):
+        assert _retry_after_seconds(retry_after) == expected
+
+
+def test_start_sets_idle_event_once_nothing_changes(
+    jira_cache_updater: JiraCacheUpdater,
+):
+    idle_event = threading.Event()
+    # Checks write 3 issues, then none. The event is looked at when the
+    # following check starts.
+    results = iter([3, 0])
+    idle_when_checked = []
+
+    def run_check() -> int:
+        idle_when_checked.append(idle_event.is_set())
+        result = next(results, None)
+        if result is None:
+            raise Exception("Stop")
+        return result
+
+    with patch.object(
+        jira_cache_updater, "run_check", side_effect=run_check
+    ), patch.object(jira_cache_updater._stop_event, "wait"), pytest.raises(
+        Exception, match="Stop"
+    ):
+        jira_cache_updater.start(idle_event)
+
+    assert idle_when_checked == [False, False, True]
+
+
+def test_start_skips_missed_ticks(jira_cache_updater: JiraCacheUpdater):
+    # seconds_per_check is 1. The first check overruns to t=5, the second
+    # takes half a second.
+    monotonic_times = [0.0, 5.0, 5.0, 5.5, 5.5]
+    with patch.object(
+        jira_cache_updater, "run_check"
+    ) as mock_run_check, patch.object(
+        jira_cache_updater._stop_event, "wait"
+    ) as mock_wait, patch(
+        "tlt.jira_cache_updater.time.monotonic", side_effect=monotonic_times
+    ):
+        mock_run_check.side_effect = [1, 1, Exception("Stop")]
+
+        with pytest.raises(Exception, match="Stop"):
+            jira_cache_updater.start()
+
+    # No catching up on the ticks at 1 to 4: the second check starts at once
+    # and the third one tick after it, not back-to-back
+    assert [c.args[0] for c in mock_wait.call_args_list] == [0.0, 0.5]
+
+
+def test_start_waits_at_least_the_server_interval(
+    jira_cache_updater: JiraCacheUpdater,
+):
+    jira_cache_updater._server_min_interval = 60.0
+    with patch.object(
+        jira_cache_updater, "run_check"
+    ) as mock_run_check, patch.object(
+        jira_cache_updater._stop_event, "wait"
+    ) as mock_wait:
+        mock_run_check.side_effect = [1, Exception("Stop")]
+
+        with pytest.raises(Exception, match="Stop"):
+            jira_cache_updater.start()
+
+    # seconds_per_check is 1, but the server asked for 60
+    assert mock_wait.call_args.args[0] > 59
+
+
+def test_start_checkpoints_and_optimizes_the_database(
+    jira_cache_updater: JiraCacheUpdater,
+):
+    statements: list[str] = []
+    jira_cache_updater._conn.set_trace_callback(statements.append)
+    # A large check, a small one just before the optimize interval is up,
+    # and an empty one just after
+    issues_written = iter([WAL_CHECKPOINT_MIN_ISSUES + 1, 1, 0])
+    monotonic_times = [0.0, 1.0, 1.0, 2.0, 2.0, OPTIMIZE_INTERVAL_SECONDS, 0.0]
+    checks = []
+
+    def run_check() -> int:
+        checks.append(statements.copy())
+        statements.clear()
+        return next(issues_written)
+
+    with patch.object(
+        jira_cache_updater, "run_check", side_effect=run_check
+    ), patch.object(jira_cache_updater._stop_event, "wait"), patch(
+        "tlt.jira_cache_updater.time.monotonic", side_effect=monotonic_times
+    ), pytest.raises(
+        StopIteration
+    ):
+        jira_cache_updater.start()
+
+    assert checks[1:] == [
+        ["PRAGMA wal_checkpoint(PASSIVE)"],
+        [],
+        ["PRAGMA optimize"],
+    ]
+
 
 def test_start(jira_cache_updater: JiraCacheUpdater):
-    with patch.object(jira_cache_updater, "run_check") as mock_run_check, patch(
-        "time.sleep"
-    ) as mock_sleep:
+    with patch.object(
+        jira_cache_updater, "run_check"
+    ) as mock_run_check, patch.object(
+        jira_cache_updater._stop_event, "wait"
+    ) as mock_wait:
         # Make start() run only twice
-        mock_run_check.side_effect = [None, None, Exception("Stop")]
+        mock_run_check.side_effect = [1, 1, Exception("Stop")]
 
         with pytest.raises(Exception, match="Stop"):
             jira_cache_updater.start()
 
         assert mock_run_check.call_count == 3
-        assert mock_sleep.call_count == 2
+        assert mock_wait.call_count == 2
+
+
+def test_stop(jira_cache_updater: JiraCacheUpdater):
+    def run_check() -> int:
+        jira_cache_updater.stop()
+        return 0
+
+    with patch.object(jira_cache_updater, "run_check") as mock_run_check:
+        mock_run_check.side_effect = run_check
+
+        jira_cache_updater.start()
+
+        assert mock_run_check.call_count == 1
+
+
+def test_file_db_connection_supplier_uses_wal(tmp_path: Path):
+    supplier = create_file_db_connection_supplier(tmp_path / "cache.sqlite")
+    connections = []
+
+    def check_connection() -> None:
+        with supplier() as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+            assert conn.execute("PRAGMA cache_size").fetchone()[0] == -20000
+            connections.append(conn)
+
+    check_connection()
+    # Another thread gets its own connection. It only needs the
+    # per-connection settings, and still finds the database in WAL mode.
+    thread = threading.Thread(target=check_connection)
+    thread.start()
+    thread.join()
+    assert len(connections) == 2
+    assert connections[0] is not connections[1]
+
+
+def test_file_db_connection_supplier_sets_cache_size(tmp_path: Path):
+    supplier = create_file_db_connection_supplier(
+        tmp_path / "cache.sqlite", cache_size_kib=65536
+    )
+    with supplier() as conn:
+        assert conn.execute("PRAGMA cache_size").fetchone()[0] == -65536
+
+
+def test_file_db_connection_supplier_reuses_connection(tmp_path: Path):
+    supplier = create_file_db_connection_supplier(tmp_path / "cache.sqlite")
+    with supplier() as conn:
+        conn.execute("CREATE TABLE t (x)")
+    with supplier() as conn_again:
+        assert conn_again is conn
+        # Still open after the first with statement ended
+        conn_again.execute("SELECT * FROM t")
+
+
+def test_file_db_connection_supplier_closes_connection_on_thread_exit(
+    tmp_path: Path,
+):
+    supplier = create_file_db_connection_supplier(tmp_path / "cache.sqlite")
+    connections = []
+
+    def use_connection() -> None:
+        with supplier() as conn:
+            connections.append(conn)
+
+    thread = threading.Thread(target=use_connection)
+    thread.start()
+    thread.join()
+
+    with pytest.raises(sqlite3.ProgrammingError, match="closed"):
+        connections[0].execute("SELECT 1")
 
 
 if __name__ == "__main__":
@@ -1,9 +1,78 @@
+import argparse
+import sqlite3
 import sys
+import threading
+from contextlib import closing
 
 import pytest
 
-def test_stub():
-    assert True
+from tlt.tlt import (
+    jira_project_argument,
+    positive_int_argument,
+    wait_for_cache_update,
+)
+
+
+@pytest.mark.parametrize("name", ["A", "PROJ", "AB_12"])
+def test_jira_project_argument_accepts_valid_names(name: str) -> None:
+    assert jira_project_argument(name) == name
+
+
+@pytest.mark.parametrize("name", ["", "proj", "1AB", "_AB", "AB-1", "AB\n"])
+def test_jira_project_argument_rejects_invalid_names(name: str) -> None:
+    with pytest.raises(argparse.ArgumentTypeError):
+        jira_project_argument(name)
+
+
+def test_positive_int_argument_accepts_positive_integers() -> None:
+    assert positive_int_argument("1000") == 1000
+
+
+@pytest.mark.parametrize("value", ["0", "-5", "ten", "1.5"])
+def test_positive_int_argument_rejects_other_values(value: str) -> None:
+    with pytest.raises(argparse.ArgumentTypeError):
+        positive_int_argument(value)
+
+
+def test_wait_for_cache_update_returns_once_updater_is_idle(
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE issues (key TEXT PRIMARY KEY)")
+    conn.executemany("INSERT INTO issues VALUES (?)", [("A-1",), ("A-2",)])
+    idle_event = threading.Event()
+    # Set by the "updater" while the caller waits
+    timer = threading.Timer(0.05, idle_event.set)
+    timer.start()
+
+    with closing(conn):
+        assert wait_for_cache_update(lambda: conn, 60, idle_event, timer)
+    timer.join()
+
+    assert capsys.readouterr().out.endswith("Finished with 2 issues.\n")
+
+
+def test_wait_for_cache_update_returns_if_updater_thread_dies(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    def failing_check() -> None:
+        raise RuntimeError("Jira is down")
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE issues (key TEXT PRIMARY KEY)")
+    updater_thread = threading.Thread(target=failing_check)
+    # Keep the expected traceback out of the test output
+    monkeypatch.setattr(threading, "excepthook", lambda _: None)
+    updater_thread.start()
+    updater_thread.join()
+
+    with closing(conn):
+        # The idle event is never set, so without noticing the dead thread
+        # this would wait forever
+        assert not wait_for_cache_update(
+            lambda: conn, 0.01, threading.Event(), updater_thread
+        )
+
 
 if __name__ == "__main__":
     sys.exit(pytest.main([__file__]))
@@ -2,18 +2,27 @@
 
 import json
 import logging
+import math
+import socket
 import sqlite3
+import threading
 import time
+import weakref
+import zlib
 from collections import defaultdict
-from collections.abc import Callable, Generator, Iterable
-from contextlib import AbstractContextManager, contextmanager
+from collections.abc import Callable, Generator, Iterable, Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import AbstractContextManager, ExitStack, contextmanager
 from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from itertools import islice
 from pathlib import Path
-from typing import cast
+from typing import Any, TypeVar, cast
 
-import requests
-from requests.auth import AuthBase
+from requests.adapters import HTTPAdapter
 from requests_ratelimiter import LimiterSession
+from urllib3.connection import HTTPConnection
 
 from tlt.raw_issue_dict import (
     AssigneeDict,
@@ -24,33 +33,161 @@ from tlt.raw_issue_dict import (
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# Reused for every issue and request body: compact output without the
+# per-call encoder construction json.dumps does for non-default options.
+# The input is always freshly decoded JSON, so it cannot be circular.
+_JSON_ENCODER = json.JSONEncoder(
+    ensure_ascii=False, separators=(",", ":"), check_circular=False
+)
+
 # Type alias for a function that returns a context manager for database connections
 # it can be used in a with statement to manage a connection
 ConnectionSupplier = Callable[[], AbstractContextManager[sqlite3.Connection]]
 
 
-class BearerAuth(AuthBase):
-    """Custom authentication class for adding a Bearer token to requests."""
+# Upsert of one issue row. It is run through executemany on the updater's
+# long-lived connection, so sqlite3's statement cache compiles it only once.
+UPSERT_ISSUE_SQL = """
+    INSERT INTO issues (
+        key,
+        json_data,
+        assignee_name,
+        last_updated,
+        original_seconds_estimated
+    ) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(key) DO UPDATE SET
+        json_data=excluded.json_data,
+        assignee_name=excluded.assignee_name,
+        last_updated=excluded.last_updated,
+        original_seconds_estimated=excluded.original_seconds_estimated,
+        cache_time=excluded.cache_time
+    -- Leave rows that would not change alone, so they cost no page writes,
+    -- unless they were cached without the JSON that is now included
+    WHERE last_updated IS NOT excluded.last_updated
+        OR (json_data IS NULL AND excluded.json_data IS NOT NULL)
+"""
 
-    def __init__(self, token: str) -> None:
-        """
-        Initialize with the provided token.
+# Upsert of one user's time spent on one issue, also run through executemany
+UPSERT_SECONDS_SPENT_SQL = """
+    INSERT INTO seconds_spent (issue_key, user_key, seconds)
+    VALUES (?, ?, ?)
+    ON CONFLICT(issue_key, user_key) DO UPDATE SET
+        seconds=excluded.seconds
+    WHERE seconds <> excluded.seconds
+"""
 
-        Args:
-            token: The bearer token for authentication.
-        """
-        self._token = token
+# Maximum number of issues converted and passed to one executemany call
+ROWS_PER_EXECUTEMANY = 1000
 
-    def __call__(self, r: requests.PreparedRequest) -> requests.PreparedRequest:
-        """
-        Attach the Authorization header to the request.
+# Number of written issues after which a long check commits part way, to
+# bound the size of the WAL
+ISSUES_PER_COMMIT = 10000
 
-        Returns:
-            The modified request with the Authorization header.
-        """
-        if r.headers is not None:
-            r.headers["Authorization"] = f"Bearer {self._token}"
-        return r
+# start() checkpoints the WAL after a check that wrote more issues than
+# this, rather than leaving it to SQLite's automatic checkpoint
+WAL_CHECKPOINT_MIN_ISSUES = 500
+
+# Seconds between the PRAGMA optimize runs in start(), which keep the query
+# planner's statistics up to date as the cache grows
+OPTIMIZE_INTERVAL_SECONDS = 15 * 60
+
+# The fields Issue.from_raw reads, and so the only ones requested when the
+# full issue JSON is not cached
+ISSUE_FIELDS = ("updated", "assignee", "timetracking", "worklog")
+
+# Number of times a page request is retried after the server answers 429 Too
+# Many Requests, and the wait before a retry when the answer says nothing
+MAX_RATE_LIMITED_RETRIES = 5
+DEFAULT_RETRY_AFTER_SECONDS = 5.0
+
+# Seconds an idle connection to Jira waits before sending a TCP keepalive
+# probe, and between probes
+TCP_KEEPALIVE_SECONDS = 60
+
+# Fields that are not read from the cache and can be large (comment and
+# attachment bodies, watcher and voter lists)
+DEFAULT_EXCLUDED_FIELDS = ("comment", "watches", "votes", "attachment")
+
+# zlib level for the cached issue JSON. Jira JSON is very repetitive, so low
+# levels already shrink it about 4x at a fraction of the default's cost.
+JSON_COMPRESSION_LEVEL = 3
+
+# Key in the meta table of the zlib preset dictionary for the issue JSON
+JSON_ZDICT_KEY = "issue_json_zdict"
+
+# Key in the meta table set by an updater that leaves out the issue JSON, so
+# the next one that includes it fetches every issue again to fill it in
+JSON_BACKFILL_KEY = "issue_json_backfill"
+
+# Size of the preset dictionary. zlib only looks back 32 KiB, so any more
+# would never be used.
+JSON_ZDICT_SIZE = 32 * 1024
+
+# Number of issues the preset dictionary is sampled from, each giving it an
+# equal share. Issues written before that many have been seen are compressed
+# without a dictionary.
+JSON_ZDICT_SAMPLE_ISSUES = 32
+
+
+def read_issue_json_zdict(conn: sqlite3.Connection) -> bytes | None:
+    """
+    Read the preset dictionary the issue JSON is compressed with.
+
+    Args:
+        conn: A connection to the cache database.
+
+    Returns:
+        The dictionary, or None if no issue has been cached with one yet.
+    """
+    result = conn.execute(
+        "SELECT value FROM meta WHERE key = ?", (JSON_ZDICT_KEY,)
+    ).fetchone()
+    return result[0] if result else None
+
+
+def decode_issue_json(
+    json_data: bytes | str, zdict: bytes | None = None
+) -> RawJiraIssueDict:
+    """
+    Decode the json_data column of the issues table.
+
+    Args:
+        json_data: The stored value. Rows cached before compression was
+            introduced hold plain JSON text.
+        zdict: The preset dictionary from read_issue_json_zdict(). Rows
+            compressed before there was a dictionary decode with or
+            without it.
+
+    Returns:
+        The raw issue data.
+    """
+    if isinstance(json_data, bytes):
+        if zdict:
+            json_data = zlib.decompressobj(zdict=zdict).decompress(json_data)
+        else:
+            json_data = zlib.decompress(json_data)
+    return cast(RawJiraIssueDict, json.loads(json_data))
+
+
+def _compress_issue_json(json_bytes: bytes, zdict: bytes | None) -> bytes:
+    """
+    Compress issue JSON for the json_data column of the issues table.
+
+    Args:
+        json_bytes: The UTF-8 JSON of the issue.
+        zdict: The preset dictionary to compress with, if any.
+
+    Returns:
+        The compressed JSON. See decode_issue_json().
+    """
+    compressor = (
+        zlib.compressobj(JSON_COMPRESSION_LEVEL, zdict=zdict)
+        if zdict
+        else zlib.compressobj(JSON_COMPRESSION_LEVEL)
+    )
+    return compressor.compress(json_bytes) + compressor.flush()
 
 
 # noinspection SpellCheckingInspection
@@ -59,13 +196,15 @@ TIME_TRACKING = "timetracking"
 WORK_LOGS = "worklogs"
 
 
-@dataclass
+@dataclass(slots=True)
 class Issue:
     """A Jira issue with some clean-up and aggregation
 
     Attributes:
         key: The issue key.
-        json_data: The JSON data for the issue.
+        json_data: The zlib-compressed UTF-8 JSON data for the issue, or None
+            if it is not kept. See decode_issue_json() and
+            read_issue_json_zdict().
         assignee_name: The name of the assignee or None if unassigned.
         last_updated: The last time the issue was updated.
         seconds_spent: A dictionary of user keys to the number of seconds spent.
@@ -73,7 +212,7 @@ class Issue:
     """
 
     key: str
-    json_data: str
+    json_data: bytes | None
     assignee_name: str | None
     last_updated: str
     seconds_spent: dict[str, int]
@@ -90,12 +229,20 @@ class Issue:
         return sum(self.seconds_spent.values())
 
     @staticmethod
-    def from_raw(raw_issue: RawJiraIssueDict) -> "Issue":
+    def from_raw(
+        raw_issue: RawJiraIssueDict,
+        zdict: bytes | None = None,
+        *,
+        include_json: bool = True,
+    ) -> "Issue":
         """
         Convert a RawJiraIssueDict to an Issue.
 
         Args:
             raw_issue: The raw issue data to convert.
+            zdict: The preset dictionary to compress the JSON with, if any.
+            include_json: Whether to keep the issue's JSON. If False,
+                json_data is None.
 
         Returns:
             The Issue object created from the raw issue data.
@@ -116,9 +263,16 @@ class Issue:
             seconds_spent[work_log["author"]["key"]] += work_log[
                 "timeSpentSeconds"
             ]
+        json_data = (
+            _compress_issue_json(
+                _JSON_ENCODER.encode(raw_issue).encode("utf-8"), zdict
+            )
+            if include_json
+            else None
+        )
         return Issue(
             key=raw_issue["key"],
-            json_data=json.dumps(raw_issue),
+            json_data=json_data,
             last_updated=raw_issue["fields"]["updated"],
             seconds_spent=seconds_spent,
             original_seconds_estimated=original_estimate_seconds,
@@ -137,12 +291,18 @@ class JiraCacheUpdater:
         connection_supplier: ConnectionSupplier,
         seconds_per_check: float = 5,
         requests_per_second: float = 1,
+        batch_size: int = 1000,
+        fields: Iterable[str] = ("*all",),
+        exclude_fields: Iterable[str] = DEFAULT_EXCLUDED_FIELDS,
+        *,
+        include_full_json: bool = True,
     ) -> None:
         """
         Initialize the JiraCacheUpdater with server details, token, JQL query,
         and a database connection manager.
 
-        Also creates tables in the database if it does not have them.
+        Opens the database connection the updater uses for its lifetime (see
+        close()) and creates tables in the database if it does not have them.
 
         Args:
             jira_server_base: Base URL of the Jira server.
@@ -151,29 +311,114 @@ class JiraCacheUpdater:
             connection_supplier: A callable that returns a context manager for database connections.
             seconds_per_check: Minimum number of seconds between checks.
             requests_per_second: Number of requests per second allowed for rate limiting.
+            batch_size: Number of issues to request per page. If the server
+                returns fewer, this is lowered to the server's actual cap.
+            fields: The fields to request for each issue, in the form the
+                search API takes (e.g. "*all" or "summary"). The fields
+                Issue.from_raw reads must be included.
+            exclude_fields: Fields to leave out of the response even though
+                fields includes them. Large fields nothing reads from the
+                cache are excluded by default to cut the download size.
+            include_full_json: Whether to cache each issue's JSON. If False,
+                only ISSUE_FIELDS are requested (fields and exclude_fields
+                are ignored) and json_data is left NULL, which makes the
+                downloads and the database much smaller. If it is True
+                after an updater ran with it False, the first check fetches
+                every issue again to fill the JSON in.
+
+        Raises:
+            ValueError: If batch_size is less than 1.
         """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, not {batch_size}")
         self.jira_server_base = jira_server_base
         self.jira_token = jira_token
         self.jql = jql
         self.connection_supplier = connection_supplier
         self.seconds_per_check = seconds_per_check
+        self.batch_size = batch_size
+        self.include_full_json = include_full_json
+        self.fields = (
+            [*fields, *(f"-{field}" for field in exclude_fields)]
+            if include_full_json
+            else list(ISSUE_FIELDS)
+        )
+        # Several page requests can wait on the network while the rate
+        # limiter releases them one at a time
+        self.max_workers = max(1, int(requests_per_second * 4))
         self.session = LimiterSession(per_second=requests_per_second)
-        self.auth = BearerAuth(jira_token)
+        # Keep connections to the server alive so later pages and checks
+        # reuse the TCP/TLS connection instead of handshaking again. Every
+        # page worker gets its own pooled connection; a smaller pool would
+        # open and discard a connection per page beyond its size.
+        adapter = _KeepAliveAdapter(
+            pool_connections=4,
+            pool_maxsize=max(16, self.max_workers),
+            pool_block=False,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {
+                "Accept": "application/json; charset=utf-8",
+                "Content-Type": "application/json; charset=utf-8",
+                "Authorization": f"Bearer {jira_token}",
+            }
+        )
+
+        # One connection for the life of the updater keeps SQLite's page
+        # and statement caches warm between checks
+        self._exit_stack = ExitStack()
+        self._conn = self._exit_stack.enter_context(connection_supplier())
+        # Serializes writes in case the connection is used from more than
+        # one thread
+        self._lock = threading.Lock()
+        self._last_check_time: float | None = None
+        self._zdict: bytes | None = None
+        # Whether the next check must fetch every issue to fill in the JSON
+        # a run without include_full_json left out, see _init_db()
+        self._json_backfill_pending = False
+        # The start of each issue's JSON sampled for the dictionary so far,
+        # see _sample_zdict()
+        self._zdict_samples: list[bytes] = []
+        self._stop_event = threading.Event()
+        # The shortest interval between requests the server's rate limit
+        # headers allow, see _note_rate_limit()
+        self._server_min_interval = 0.0
+        # How long the last check took, see run_check()
+        self._last_check_seconds = 0.0
 
         self._init_db()
 
+    def close(self) -> None:
+        """
+        Release the database connection the constructor got from the
+        connection supplier. Whether that closes it is up to the supplier.
+        """
+        self._exit_stack.close()
+
+    def __enter__(self) -> "JiraCacheUpdater":
+        """Return the updater itself; its connection is already open."""
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """Close the database connection, see close()."""
+        self.close()
+
     def _init_db(self) -> None:
         """
         Initialize the SQLite database by creating necessary tables if they do
-        not exist.
+        not exist, and load the time of the last check.
         """
-        with self.connection_supplier() as conn:
+        with self._lock, self._conn as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
                 CREATE TABLE IF NOT EXISTS issues (
                     key TEXT PRIMARY KEY,
-                    json_data TEXT,
+                    -- zlib-compressed JSON, see decode_issue_json(). NULL
+                    -- if the updater does not include the full JSON.
+                    json_data BLOB,
                     -- The name of the assignee or None if unassigned
                     -- For the same individual, this should be the
                     -- same as the key in the seconds_spent table
@@ -185,6 +430,10 @@ class JiraCacheUpdater:
                 )
             """
             )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_issues_last_updated "
+                "ON issues(last_updated)"
+            )
             cursor.execute(
                 """
                 CREATE TABLE IF NOT EXISTS seconds_spent (
@@ -195,117 +444,349 @@ class JiraCacheUpdater:
                 )
             """
             )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_seconds_spent_user "
+                "ON seconds_spent(user_key)"
+            )
             cursor.execute(
                 """
                 CREATE TABLE IF NOT EXISTS checks (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    -- Only one row is kept, see _set_last_check_time()
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
                     last_check_time REAL
                 )
             """
             )
-            conn.commit()
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value BLOB
+                )
+            """
+            )
+            self._zdict = read_issue_json_zdict(conn)
+            self._compress_legacy_issue_json(cursor)
+            # MAX() rather than a sort, in case the table predates the
+            # single row and still holds one row per check
+            cursor.execute("SELECT MAX(last_check_time) FROM checks")
+            self._last_check_time = cursor.fetchone()[0]
+            if not self.include_full_json:
+                cursor.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, 1)",
+                    (JSON_BACKFILL_KEY,),
+                )
+            elif cursor.execute(
+                "SELECT 1 FROM meta WHERE key = ?", (JSON_BACKFILL_KEY,)
+            ).fetchone():
+                # Issues cached without their JSON are only fetched again
+                # once they change, so backfill them all in the first check.
+                # Issues no longer matching the JQL keep a NULL json_data.
+                log.info("Fetching the JSON of issues cached without it")
+                self._last_check_time = None
+                self._json_backfill_pending = True
+
+    def _store_zdict(self, cursor: sqlite3.Cursor, zdict: bytes) -> None:
+        """
+        Store the preset dictionary for compressing issue JSON.
+
+        It must never change once stored, or the rows compressed with it
+        become unreadable. It is written in the caller's transaction, so it
+        is rolled back with the rows compressed with it.
+
+        Args:
+            cursor: The cursor to write with.
+            zdict: The dictionary, see _sample_zdict().
+        """
+        cursor.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?)",
+            (JSON_ZDICT_KEY, zdict),
+        )
+        self._zdict = zdict
+
+    def _sample_zdict(
+        self, cursor: sqlite3.Cursor, issue_jsons: Iterable[bytes]
+    ) -> None:
+        """
+        Sample issue JSON for the preset dictionary, and store the dictionary
+        once JSON_ZDICT_SAMPLE_ISSUES issues have been sampled.
+
+        Most of an issue's JSON is field names, URLs and user objects that
+        every issue of the same Jira instance shares, so parts of a few dozen
+        real issues make a good dictionary for the rest. Each issue gives
+        only the start of its JSON, so one large issue cannot fill the
+        dictionary. The sample is kept across pages and checks until it is
+        complete.
+
+        Args:
+            cursor: The cursor to store the dictionary with.
+            issue_jsons: The UTF-8 JSON of the issues to sample. Only as many
+                are consumed as the sample still needs.
+        """
+        share = JSON_ZDICT_SIZE // JSON_ZDICT_SAMPLE_ISSUES
+        needed = JSON_ZDICT_SAMPLE_ISSUES - len(self._zdict_samples)
+        self._zdict_samples.extend(
+            issue_json[:share] for issue_json in islice(issue_jsons, needed)
+        )
+        if len(self._zdict_samples) == JSON_ZDICT_SAMPLE_ISSUES:
+            self._store_zdict(cursor, b"".join(self._zdict_samples))
+            self._zdict_samples.clear()
+
+    def _compress_legacy_issue_json(self, cursor: sqlite3.Cursor) -> None:
+        """
+        Compress the issue JSON cached as text by earlier versions.
+
+        This runs once per database: afterwards no rows are left as text. If
+        there is no preset dictionary yet, these rows are sampled for it.
+
+        Args:
+            cursor: The cursor to read and write with.
+        """
+        while rows := cursor.execute(
+            "SELECT key, json_data FROM issues "
+            "WHERE typeof(json_data) = 'text' LIMIT ?",
+            (ROWS_PER_EXECUTEMANY,),
+        ).fetchall():
+            issue_jsons = [json_data.encode("utf-8") for _, json_data in rows]
+            if self._zdict is None:
+                self._sample_zdict(cursor, issue_jsons)
+            log.info("Compressing %d issues cached as text", len(rows))
+            cursor.executemany(
+                "UPDATE issues SET json_data = ? WHERE key = ?",
+                [
+                    (_compress_issue_json(issue_json, self._zdict), key)
+                    for issue_json, (key, _) in zip(
+                        issue_jsons, rows, strict=True
+                    )
+                ],
+            )
 
     def _get_last_check_time(self) -> float | None:
         """
-        Retrieve the time of the last check from the database.
+        Return the time of the last check.
+
+        The value is read from the database once by _init_db() and kept up
+        to date by run_check(), so no query is needed.
 
         Returns:
             The timestamp of the last check, or None if no checks have been performed.
         """
-        with self.connection_supplier() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT last_check_time FROM checks "
-                "ORDER BY last_check_time DESC LIMIT 1"
-            )
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return self._last_check_time
 
-    def _set_last_check_time(self, check_time: float) -> None:
+    @staticmethod
+    def _set_last_check_time(cursor: sqlite3.Cursor, check_time: float) -> None:
         """
         Record the time of the latest check in the database.
 
+        The caller owns the transaction: run_check() commits this together
+        with the issues of the check and then updates the in-memory copy.
+
         Args:
+            cursor: The cursor to write with.
             check_time: The timestamp of the latest check.
         """
-        with self.connection_supplier() as conn:
-            cursor = conn.cursor()
+        # checks only needs its latest row, so keep overwriting one row
+        # rather than growing the table every check
+        cursor.execute(
+            "INSERT OR REPLACE INTO checks (id, last_check_time) "
+            "VALUES (1, ?)",
+            (check_time,),
+        )
+
+    def _get_cached_last_updated(
+        self, cursor: sqlite3.Cursor, keys: list[str]
+    ) -> dict[str, str]:
+        """
+        Look up the cached last_updated value of the given issues.
+
+        When the full JSON is included, issues cached without it are left
+        out, so they are written again even if they have not changed.
+
+        Args:
+            cursor: The cursor to query with.
+            keys: The keys of the issues to look up.
+
+        Returns:
+            A dictionary from issue key to last_updated for the keys that are
+            in the cache.
+        """
+        last_updated: dict[str, str] = {}
+        json_condition = (
+            " AND json_data IS NOT NULL" if self.include_full_json else ""
+        )
+        # Stay well below SQLite's limit on the number of bound parameters
+        for chunk in _batched(keys, 500):
+            placeholders = ", ".join("?" * len(chunk))
             cursor.execute(
-                "INSERT INTO checks (last_check_time) VALUES (?)", (check_time,)
+                "SELECT key, last_updated FROM issues "  # noqa: S608
+                f"WHERE key IN ({placeholders}){json_condition}",
+                chunk,
             )
-            conn.commit()
+            last_updated.update(cursor.fetchall())
+        return last_updated
 
-    def _update_issue(self, raw_issue: RawJiraIssueDict) -> None:
+    def _update_issues(
+        self, cursor: sqlite3.Cursor, raw_issues: Iterable[RawJiraIssueDict]
+    ) -> int:
         """
-        Insert or update an issue in the database.
+        Insert or update a batch of issues in the database.
+
+        Nothing is committed; the caller owns the transaction. Issues whose
+        updated time matches the cached copy are skipped without being
+        converted.
 
         Args:
-            raw_issue: The issue data to be inserted or updated.
+            cursor: The cursor to write with.
+            raw_issues: The issue data to be inserted or updated.
+
+        Returns:
+            The number of issues written.
         """
-        with self.connection_supplier() as conn:
-            log.debug(f"Updating issue {raw_issue['key']}")
-            issue = Issue.from_raw(raw_issue)
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO issues (
-                    key,
-                    json_data,
-                    assignee_name,
-                    last_updated,
-                    original_seconds_estimated
-                ) VALUES (?, ?, ?, ?, ?, ?)
-                ON CONFLICT(key) DO UPDATE SET
-                    json_data=excluded.json_data,
-                    assignee_name=excluded.assignee_name
-                    last_updated=excluded.last_updated
-                    original_seconds_estimated=excluded.original_seconds_estimated
-            """,
+        raw_issues = list(raw_issues)
+        cached_updated = self._get_cached_last_updated(
+            cursor, [raw_issue["key"] for raw_issue in raw_issues]
+        )
+        changed_raw_issues = [
+            raw_issue
+            for raw_issue in raw_issues
+            if cached_updated.get(raw_issue["key"])
+            != raw_issue["fields"]["updated"]
+        ]
+        # Lazy %-formatting: this runs for every page, and the message is
+        # only built when debug logging is on
+        log.debug(
+            "Updating %d of %d issues (the rest are unchanged)",
+            len(changed_raw_issues),
+            len(raw_issues),
+        )
+        if (
+            self._zdict is None
+            and self.include_full_json
+            and changed_raw_issues
+        ):
+            # The first issues written choose the dictionary for all later
+            # ones
+            self._sample_zdict(
+                cursor,
                 (
-                    issue.key,
-                    issue.json_data,
-                    issue.assignee_name,
-                    issue.last_updated,
-                    issue.original_seconds_estimated,
+                    _JSON_ENCODER.encode(raw_issue).encode("utf-8")
+                    for raw_issue in changed_raw_issues
                 ),
             )
-            for user_name, seconds_spent in issue.seconds_spent.items():
-                cursor.execute(
-                    """
-                    INSERT INTO seconds_spent (issue_key, user_key, seconds)
-                    VALUES (?, ?, ?)
-                    ON CONFLICT(issue_key, user_key) DO UPDATE SET
-                        seconds=excluded.seconds
-                    """,
-                    (issue.key, user_name, seconds_spent),
+        # Convert and write in bounded chunks so a large batch does not
+        # hold every converted issue and row tuple at once
+        for chunk in _batched(changed_raw_issues, ROWS_PER_EXECUTEMANY):
+            issues = [
+                Issue.from_raw(
+                    raw_issue,
+                    self._zdict,
+                    include_json=self.include_full_json,
                 )
-            conn.commit()
+                for raw_issue in chunk
+            ]
+            cursor.executemany(
+                UPSERT_ISSUE_SQL,
+                [
+                    (
+                        issue.key,
+                        issue.json_data,
+                        issue.assignee_name,
+                        issue.last_updated,
+                        issue.original_seconds_estimated,
+                    )
+                    for issue in issues
+                ],
+            )
+            cursor.executemany(
+                UPSERT_SECONDS_SPENT_SQL,
+                [
+                    (issue.key, user_name, seconds_spent)
+                    for issue in issues
+                    for user_name, seconds_spent in issue.seconds_spent.items()
+                ],
+            )
+        return len(changed_raw_issues)
 
-    def run_check(self) -> None:
+    def run_check(self) -> int:
         """
         Run a check for updated issues since the last check and update the
         database accordingly.
+
+        Returns:
+            The number of new or changed issues written.
         """
         time_started = time.time()
         last_check_time = self._get_last_check_time()
         jql = self.jql
         if last_check_time:
-            # Prepend a condition to the JQL query to only fetch issues updated since the last check
-            last_check_str = time.strftime(
-                "%Y-%m-%d %H:%M", time.gmtime(last_check_time)
+            # Prepend a condition to the JQL query to only fetch issues
+            # updated since the last check. Jira reads absolute dates in the
+            # user's profile time zone and by the minute, so use a relative
+            # one: it needs no time zone, is immune to skew between our clock
+            # and the server's, and covers just the time since the last check
+            # plus a minute. Jira works the window out again for every page,
+            # so its lower bound moves forward while the check paginates; it
+            # is widened by as long as the last check took to stay before the
+            # last check time. Issues fetched again are skipped unconverted
+            # by _update_issues. At least a minute is asked for, in case our
+            # clock was set back.
+            minutes = max(
+                1,
+                math.ceil((time_started - last_check_time) / 60)
+                + 1
+                + math.ceil(self._last_check_seconds / 60),
             )
-            jql = f'updated >= "{last_check_str}" AND ({jql})'
+            jql = f"updated >= -{minutes}m AND ({jql})"
 
         log.debug(f"Running Jira check with JQL: {jql}")
-        for issue in self._download_issues(jql):
-            # Update each issue in the database
-            self._update_issue(issue)
+        # The whole check is one transaction (one commit and fsync) unless
+        # it writes so many issues that the WAL should be flushed part way
+        with self._lock, self._conn as conn:
+            # A dictionary stored by a check that was rolled back is gone
+            self._zdict = read_issue_json_zdict(conn)
+            cursor = conn.cursor()
+            issues_written = issues_since_commit = 0
+            for page in _batched(self._download_issues(jql), self.batch_size):
+                page_issues_written = self._update_issues(cursor, page)
+                issues_written += page_issues_written
+                issues_since_commit += page_issues_written
+                if issues_since_commit >= ISSUES_PER_COMMIT:
+                    conn.commit()
+                    issues_since_commit = 0
+            time_finished = time.time()
+            self._last_check_seconds = max(0.0, time_finished - time_started)
+            if not last_check_time:
+                # The first check backfills the whole cache, so give the
+                # query planner statistics for its indexes
+                cursor.execute("ANALYZE")
+            elif time_finished - last_check_time > (minutes - 1) * 60:
+                # The window's lower bound passed the last check time (less
+                # the minute Jira rounds to) before the last page was
+                # requested. Issues updated just after the last check may
+                # have dropped out of the results part way and shifted later
+                # ones past a page boundary, so keep the last check time for
+                # the next check to fetch them again, with a window widened
+                # by how long this one took.
+                log.warning(
+                    "Jira check took %.0f seconds and outlasted its JQL "
+                    "window; the next check covers it again",
+                    self._last_check_seconds,
+                )
+                return issues_written
 
-        # Record the time of this check started once it is finished.
-        # This ensures that if the check did not complete, the next check will
-        # not miss any issues it should have gotten. And if issues came after
-        # the check started, they will be fetched in the next check.
-        self._set_last_check_time(time_started)
+            # Record the time of this check started once it is finished.
+            # This ensures that if the check did not complete, the next check
+            # will not miss any issues it should have gotten. And if issues
+            # came after the check started, they will be fetched in the next
+            # check. It is committed with the last of the issues.
+            self._set_last_check_time(cursor, time_started)
+            if self._json_backfill_pending:
+                cursor.execute(
+                    "DELETE FROM meta WHERE key = ?", (JSON_BACKFILL_KEY,)
+                )
+        self._last_check_time = time_started
+        self._json_backfill_pending = False
+        return issues_written
 
     def _download_issues(
         self, jql: str
@@ -322,44 +803,111 @@ class JiraCacheUpdater:
         """
         yield from self._raw_issue_stream(
             self.jira_server_base,
-            self.jira_token,
             jql,
-            fields=("*all",),
-            to_expand=("names",),
+            fields=self.fields,
+            max_results_per_page=self.batch_size,
         )
 
-    def start(self) -> None:
+    def start(self, idle_event: threading.Event | None = None) -> None:
         """
         Start the periodic check for Jira issues, respecting the interval
-        between checks.
+        between checks, until stop() is called.
+
+        Checks are scheduled on the monotonic clock, so wall clock
+        adjustments do not stretch or compress the interval. If a check
+        overruns its interval, the next one starts immediately and the
+        missed ticks are skipped rather than run back-to-back. The interval
+        is stretched if the server's rate limit headers ask for a longer one.
+        Between checks, the WAL is checkpointed after a large check, and the
+        query planner's statistics are refreshed every
+        OPTIMIZE_INTERVAL_SECONDS.
+
+        Args:
+            idle_event: If given, set once a check finds nothing new, so
+                others can wait for the cache to catch up with Jira without
+                polling the database.
+        """
+        next_check_time = time.monotonic()
+        next_optimize_time = next_check_time + OPTIMIZE_INTERVAL_SECONDS
+        while not self._stop_event.is_set():
+            issues_written = self.run_check()
+            if issues_written == 0 and idle_event is not None:
+                idle_event.set()
+            if issues_written > WAL_CHECKPOINT_MIN_ISSUES:
+                self._execute_outside_transaction(
+                    "PRAGMA wal_checkpoint(PASSIVE)"
+                )
+            # Never poll faster than the server says it will serve requests
+            interval = max(self.seconds_per_check, self._server_min_interval)
+            now = time.monotonic()
+            next_check_time = max(next_check_time + interval, now)
+            if now >= next_optimize_time:
+                self._execute_outside_transaction("PRAGMA optimize")
+                next_optimize_time = now + OPTIMIZE_INTERVAL_SECONDS
+            self._stop_event.wait(next_check_time - time.monotonic())
+
+    def _execute_outside_transaction(self, sql: str) -> None:
+        """
+        Execute a statement, like a checkpoint, that must not run in the
+        middle of a check's transaction.
+
+        Args:
+            sql: The statement to execute.
+        """
+        with self._lock:
+            self._conn.execute(sql)
+
+    def _note_rate_limit(self, headers: Mapping[str, str]) -> None:
+        """
+        Remember the request interval a response's rate limit headers allow.
+
+        Jira reports its token bucket as x-ratelimit-fillrate tokens every
+        x-ratelimit-interval-seconds. Responses without them are ignored.
+
+        Args:
+            headers: The headers of a response from the server.
         """
-        while True:
-            start_time = time.time()
-            self.run_check()
-            elapsed_time = time.time() - start_time
-            if elapsed_time < self.seconds_per_check:
-                # Sleep to maintain the minimum interval between checks
-                time.sleep(self.seconds_per_check - elapsed_time)
+        interval = headers.get("x-ratelimit-interval-seconds")
+        fill_rate = headers.get("x-ratelimit-fillrate")
+        if interval is None or fill_rate is None:
+            return
+        try:
+            self._server_min_interval = float(interval) / float(fill_rate)
+        except (ValueError, ZeroDivisionError):
+            log.debug(
+                "Ignoring rate limit headers: interval %r, fill rate %r",
+                interval,
+                fill_rate,
+            )
+
+    def stop(self) -> None:
+        """Make start() return once the current check (if any) finishes."""
+        self._stop_event.set()
 
     def _raw_issue_stream(
         self,
         jira_server_base: str,
-        jira_token: str,
         jql: str,
         to_expand: Iterable[str] = (),
         fields: Iterable[str] = (),
-        max_results_per_page: int = 100,
+        max_results_per_page: int = 1000,
     ) -> Generator[RawJiraIssueDict, None, None]:
         """Download issues from Jira and return them one by one
 
         Assumes API version 2
 
-        Handles pagination
+        Handles pagination. Once the first page reports the total number of
+        matching issues, the remaining pages are requested concurrently (at
+        most ``self.max_workers`` at a time) and their issues are yielded in
+        the order the pages arrive. Otherwise, the next page is requested
+        before the issues of the current one are yielded. Either way, pages
+        download while the caller processes earlier ones.
+
+        Authentication and content headers come from ``self.session``.
 
         :param jql: The JQL query limiting the issues to download.
         :param jira_server_base: The base URL of the Jira server. (e.g.
             "https://jira.example.com")
-        :param jira_token: The personal access token for the Jira server.
         :param to_expand: The fields to expand in the response. See
             https://developer.atlassian.com/cloud/jira/platform/rest/v2/intro/#expansion
         :param fields: The fields to return in the response. "*all" starts with all
@@ -371,69 +919,278 @@ class JiraCacheUpdater:
             single page of results. The actual number of issues returned may be
             less than this number if there are fewer issues matching the query.
             This is internal to this method (since it returns all issues), but may
-            be important for performance tuning.
+            be important for performance tuning. If the server caps pages at a
+            smaller size, the cap is used for the remaining pages and
+            remembered in ``self.batch_size``.
         """
         url = f"{jira_server_base}/rest/api/2/search"
-        headers = {
-            "Accept": "application/json; charset=utf-8",
-            "Content-Type": "application/json; charset=utf-8",
-        }
-        auth = BearerAuth(jira_token)
-
-        expand_set = set(to_expand)
-        field_set = set(fields)
-        is_last_page = False
-        first_time = True
-        index_of_first_result = 0
-        while not is_last_page:
-            to_expand = expand_set | {"names"} if first_time else expand_set
-            payload = json.dumps(
+
+        expand = list(set(to_expand))
+        first_page_expand = list(set(to_expand) | {"names"})
+        # Built once; only expand, maxResults and startAt vary between pages
+        base_payload = {"fields": list(set(fields)), "jql": jql}
+
+        def fetch_page(
+            start_at: int, page_size: int, page_expand: list[str]
+        ) -> dict[str, Any]:
+            payload = _JSON_ENCODER.encode(
                 {
-                    "expand": list(to_expand),
-                    "fields": list(field_set),
-                    "jql": jql,
-                    "maxResults": max_results_per_page,
-                    "startAt": index_of_first_result,
+                    **base_payload,
+                    "expand": page_expand,
+                    "maxResults": page_size,
+                    "startAt": start_at,
                 }
-            )
-            response = self.session.post(
-                url, headers=headers, data=payload, auth=auth
-            )
-            log.debug(f"Response encoding: {response.encoding}")
-            log.debug(f"Response type: {response.headers['content-type']}")
+            ).encode("utf-8")
+            for retries_left in range(MAX_RATE_LIMITED_RETRIES, -1, -1):
+                response = self.session.post(url, data=payload)
+                self._note_rate_limit(response.headers)
+                if (
+                    response.status_code != HTTPStatus.TOO_MANY_REQUESTS
+                    or not retries_left
+                ):
+                    break
+                delay = _retry_after_seconds(
+                    response.headers.get("Retry-After")
+                )
+                log.warning(
+                    "Jira rate limited the request for issues from %d; "
+                    "retrying in %.1f seconds",
+                    start_at,
+                    delay,
+                )
+                time.sleep(delay)
             response.raise_for_status()
-            response_json = response.json()
+            # Parse the bytes directly: Jira always sends UTF-8 JSON, and
+            # response.json() would first detect the charset and decode the
+            # whole page to a str
+            return cast(dict[str, Any], json.loads(response.content))
+
+        index_of_first_result = 0
+        response_json = fetch_page(
+            index_of_first_result, max_results_per_page, first_page_expand
+        )
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
             # Do not check for unexpected or missing names in the response.
             # This might be a later feature. (See ManagementJira msr_jira.py
             # for an example implementation.)
-            if "issues" not in response_json:
-                break
-            response_issues = response_json["issues"]
-            yield from response_issues
-            index_of_first_result += len(response_issues)
-
-            is_last_page = (
-                response_json.get("isLast", False) or len(response_issues) == 0
+            while "issues" in response_json:
+                response_issues = response_json["issues"]
+                index_of_first_result += len(response_issues)
+
+                total: int | None = response_json.get("total")
+                if (
+                    response_json.get("isLast", False)
+                    or len(response_issues) == 0
+                    or (total is not None and index_of_first_result >= total)
+                ):
+                    yield from response_issues
+                    return
+                if len(response_issues) < max_results_per_page:
+                    log.warning(
+                        f"Requested {max_results_per_page} issues per page but "
+                        f"the server returned {len(response_issues)}. Using "
+                        f"{len(response_issues)} for subsequent requests."
+                    )
+                    max_results_per_page = len(response_issues)
+                    self.batch_size = max_results_per_page
+
+                if total is not None:
+                    # Knowing the total, request all the remaining pages at
+                    # once rather than waiting for each round trip in turn.
+                    # The LimiterSession still enforces the rate limit.
+                    start_ats = iter(
+                        range(
+                            index_of_first_result, total, max_results_per_page
+                        )
+                    )
+                    # Only keep a few pages in flight so that, if writing the
+                    # issues is slower than downloading them, finished pages
+                    # do not pile up in memory
+                    pending = {
+                        executor.submit(
+                            fetch_page,
+                            start_at,
+                            max_results_per_page,
+                            expand,
+                        )
+                        for start_at in islice(start_ats, self.max_workers)
+                    }
+                    # Only now hand out this page, so the next pages download
+                    # while it is being written
+                    yield from response_issues
+                    while pending:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED
+                        )
+                        for future in done:
+                            next_start_at = next(start_ats, None)
+                            if next_start_at is not None:
+                                pending.add(
+                                    executor.submit(
+                                        fetch_page,
+                                        next_start_at,
+                                        max_results_per_page,
+                                        expand,
+                                    )
+                                )
+                            # Issues are upserted independently, so arrival
+                            # order is fine
+                            yield from future.result().get("issues", [])
+                    return
+
+                # Without a total, prefetch just the next page while this one
+                # is being written
+                next_page = executor.submit(
+                    fetch_page,
+                    index_of_first_result,
+                    max_results_per_page,
+                    expand,
+                )
+                yield from response_issues
+                response_json = next_page.result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections send TCP keepalive probes.
+
+    Between checks the pooled connections sit idle. The probes stop NATs and
+    firewalls from silently dropping them, which would otherwise cost the
+    next check a stalled request and a new TCP/TLS handshake.
+    """
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        """Create the pool manager with keepalive socket options."""
+        socket_options = [
+            *HTTPConnection.default_socket_options,
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ]
+        # Probe well before common 5 minute NAT idle timeouts. These options
+        # are not available on every platform.
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            socket_options.append(
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_SECONDS)
+            )
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            socket_options.append(
+                (
+                    socket.IPPROTO_TCP,
+                    socket.TCP_KEEPINTVL,
+                    TCP_KEEPALIVE_SECONDS,
+                )
             )
+        kwargs["socket_options"] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _retry_after_seconds(retry_after: str | None) -> float:
+    """
+    Return how long a Retry-After header value asks the client to wait.
+
+    Args:
+        retry_after: The header value: a number of seconds or an HTTP date.
+            None if the response has no such header.
+
+    Returns:
+        The number of seconds to wait, DEFAULT_RETRY_AFTER_SECONDS if the
+        value is missing or cannot be parsed.
+    """
+    if retry_after is None:
+        return DEFAULT_RETRY_AFTER_SECONDS
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER_SECONDS
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def _batched(iterable: Iterable[T], n: int) -> Generator[list[T], None, None]:
+    """Split an iterable into lists of at most n items.
+
+    Args:
+        iterable: The items to split.
+        n: The maximum number of items in each list.
+
+    Yields:
+        The next list of consecutive items.
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
+@dataclass
+class _ThreadConnection:
+    """A thread's connection in create_file_db_connection_supplier()."""
+
+    conn: sqlite3.Connection
 
 
 def create_file_db_connection_supplier(
     db_path: Path,
+    cache_size_kib: int = 20000,
 ) -> ConnectionSupplier:
     """Return a function that can be called in a with statement to manage
     a SQLite connection.
 
+    Each thread gets one connection, opened on first use and kept until the
+    thread exits, so its page and statement caches stay warm and frequent
+    short reads do not pay for opening the database every time. A connection
+    must not be used after the thread that got it has exited.
+
+    File databases are put in WAL mode with synchronous=NORMAL, so the
+    updater's commits need fewer fsyncs and do not block readers of the
+    cache (or the other way around). Each connection also gets a page cache
+    of cache_size_kib and keeps temporary tables in memory.
+
     Args:
         db_path: The path to the SQLite database file.
+        cache_size_kib: The size of each connection's page cache in KiB.
     """
+    is_file_db = str(db_path) != ":memory:"
+    # WAL mode is stored in the database file, so it only needs setting by
+    # the first connection. The other settings are per connection.
+    needs_wal = is_file_db
+    needs_wal_lock = threading.Lock()
+    connections = threading.local()
+
+    def connect() -> sqlite3.Connection:
+        nonlocal needs_wal
+        # The default timeout already waits up to 5 seconds on a locked
+        # database, so busy_timeout does not need setting. The connection
+        # is used by one thread at a time, but JiraCacheUpdater may use it
+        # from another thread than the one that opened it, and it is closed
+        # by whichever thread frees it, hence check_same_thread=False.
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        with needs_wal_lock:
+            if needs_wal:
+                conn.execute("PRAGMA journal_mode=WAL")
+                needs_wal = False
+        if is_file_db:
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute(f"PRAGMA cache_size=-{cache_size_kib}")
+        return conn
 
     @contextmanager
     def connection_manager() -> Generator[sqlite3.Connection, None, None]:
-        conn = sqlite3.connect(db_path)
-        try:
-            yield conn
-        finally:
-            conn.close()
+        thread_conn: _ThreadConnection | None = getattr(
+            connections, "thread_conn", None
+        )
+        if thread_conn is None:
+            conn = connect()
+            thread_conn = connections.thread_conn = _ThreadConnection(conn)
+            # The thread's local data is freed when the thread exits, which
+            # closes the connection. Those still open at interpreter exit
+            # are closed then.
+            weakref.finalize(thread_conn, conn.close)
+        yield thread_conn.conn
 
     return cast(
         ConnectionSupplier,
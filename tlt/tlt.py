@@ -6,10 +6,8 @@ import os
 import re
 import sqlite3
 import sys
-import time
+import threading
 from dataclasses import dataclass
-from datetime import datetime, timedelta
-from multiprocessing import Process
 from pathlib import Path
 
 from tlt.jira_cache_updater import (
@@ -65,23 +63,6 @@ def read_token(token_path: Path) -> str:
         return f.read().strip()
 
 
-def get_most_recent_cache_time(conn_supplier: ConnectionSupplier) -> str | None:
-    """
-    Get the most recent cache time from the cache database.
-
-    Args:
-        conn_supplier: Supplier for database connections.
-
-    Returns:
-        The most recent cache time or None if the cache is empty.
-    """
-    with conn_supplier() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT MAX(cache_time) FROM issues")
-        result = cursor.fetchone()
-        return result[0] if result else None
-
-
 def get_num_issues(conn_supplier: ConnectionSupplier) -> int:
     """
     Get the number of issues in the cache database.
@@ -108,6 +89,8 @@ class Args:
     cache_db: Path
     seconds_between_checks: float
     rate_limit: float
+    batch_size: int
+    include_full_json: bool
     operation: str
     is_debug: bool
 
@@ -148,6 +131,20 @@ def _parse_args() -> Args:
         default=3,
         help="Rate limit in requests per second",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=positive_int_argument,
+        default=1000,
+        help="Number of issues to request per page. Default: 1000",
+    )
+    parser.add_argument(
+        "--no-issue-json",
+        dest="include_full_json",
+        action="store_false",
+        help="Only cache the fields the cache tables hold, not each "
+        "issue's full JSON. A later run without this option downloads every "
+        "issue again to add it.",
+    )
     parser.add_argument(
         "operation", choices=["update-cache"], help="Operation to perform"
     )
@@ -162,12 +159,14 @@ def _parse_args() -> Args:
         cache_db=Path(args.cache_db).expanduser(),
         seconds_between_checks=args.seconds_between_checks,
         rate_limit=args.rate_limit,
+        batch_size=args.batch_size,
+        include_full_json=args.include_full_json,
         operation=args.operation,
         is_debug=args.debug,
     )
 
 
-JIRA_PROJECT_REGEX = r"^[A-Z][A-Z0-9_]*$"
+JIRA_PROJECT_REGEX = r"[A-Z][A-Z0-9_]*"
 JIRA_PROJECT_PATTERN = re.compile(JIRA_PROJECT_REGEX)
 
 
@@ -184,13 +183,33 @@ def jira_project_argument(name: str) -> str:
     Raises:
         argparse.ArgumentTypeError: If the project is invalid
     """
-    if not JIRA_PROJECT_PATTERN.match(name):
+    if not JIRA_PROJECT_PATTERN.fullmatch(name):
         raise argparse.ArgumentTypeError(
             f"Invalid Jira project name: {name}. Must match pattern: {JIRA_PROJECT_REGEX}"
         )
     return name
 
 
+def positive_int_argument(value: str) -> int:
+    """
+    Throw on an argument that is not a positive integer.
+
+    Args:
+        value: The argument as given on the command line.
+
+    Returns:
+        The argument as an integer if it is positive.
+
+    Raises:
+        argparse.ArgumentTypeError: If the argument is not a positive integer
+    """
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError(
+            f"Invalid value: {value}. Must be a positive integer"
+        )
+    return int(value)
+
+
 def main() -> int:
     """Run the TL Tool."""
     args = _parse_args()
@@ -223,8 +242,13 @@ def main() -> int:
         )
         raise SystemExit(2) from e
 
-    # Create connection supplier
+    # Create connection suppliers. The updater gets its own, so reads from
+    # this thread never use its connection or see its uncommitted writes.
+    # Its connection does all the writing, so it gets a bigger page cache.
     connection_supplier = create_file_db_connection_supplier(args.cache_db)
+    updater_connection_supplier = create_file_db_connection_supplier(
+        args.cache_db, cache_size_kib=65536
+    )
 
     # Ensure the cache database is openable
     try:
@@ -238,58 +262,81 @@ def main() -> int:
         raise SystemExit(3) from e
 
     # Create JiraCacheUpdater
-    updater = JiraCacheUpdater(
+    with JiraCacheUpdater(
         args.url,
         jira_token,
         jql,
-        connection_supplier,
+        updater_connection_supplier,
         args.seconds_between_checks,
         args.rate_limit,
-    )
-
-    # Start the updater in a separate process
-    p = Process(target=updater.start)
-    p.start()
-
-    if args.operation == "update-cache":
-        wait_for_cache_update(connection_supplier, args.seconds_between_checks)
-    p.terminate()  # Stop the updater process
+        args.batch_size,
+        include_full_json=args.include_full_json,
+    ) as updater:
+        # Start the updater in a background thread. It spends its time
+        # waiting on Jira and SQLite, which release the GIL.
+        idle_event = threading.Event()
+        updater_thread = threading.Thread(
+            target=updater.start, args=(idle_event,), daemon=True
+        )
+        updater_thread.start()
+
+        is_up_to_date = True
+        if args.operation == "update-cache":
+            is_up_to_date = wait_for_cache_update(
+                connection_supplier,
+                args.seconds_between_checks,
+                idle_event,
+                updater_thread,
+            )
+        updater.stop()
+        updater_thread.join()
+
+    if not is_up_to_date:
+        # The thread's exception has already been printed by threading
+        print(  # noqa: T201
+            "Error: The cache updater stopped before the cache was up to "
+            "date. See the error above.",
+            file=sys.stderr,
+        )
+        return 4
     return 0
 
 
 def wait_for_cache_update(
-    connection_supplier: ConnectionSupplier, seconds_between_checks: float
-) -> None:
+    connection_supplier: ConnectionSupplier,
+    seconds_between_checks: float,
+    idle_event: threading.Event,
+    updater_thread: threading.Thread,
+) -> bool:
     """
     Wait for the cache to update.
 
     Args:
         connection_supplier: Supplier for database connections.
         seconds_between_checks: Seconds between when the updater checks.
+        idle_event: Set by the updater once a check finds nothing new. See
+            JiraCacheUpdater.start().
+        updater_thread: The thread running the updater. If it dies, for
+            example because a check raised, the idle event is never set.
+
+    Returns:
+        True once the cache is up to date, False if the updater thread
+        stopped before that.
     """
     print("Waiting for cache to update ...")  # noqa: T201
-    idle_to_wait_for = timedelta(seconds=seconds_between_checks * 3)
-    while True:
-        # The delay between checking the db also includes the time to read
-        # the db, not just the time to sleep
-        time.sleep(seconds_between_checks * 1.5)
+    # Wake up as soon as the updater is idle, and otherwise only to report
+    # progress and see whether the updater is still running
+    while not idle_event.wait(timeout=seconds_between_checks * 1.5):
+        if not updater_thread.is_alive():
+            # It may have set the event just before it stopped
+            if idle_event.is_set():
+                break
+            return False
         num_issues = get_num_issues(connection_supplier)
         print(f"{num_issues} issues ...")  # noqa: T201
-
-        most_recent_change = get_most_recent_cache_time(connection_supplier)
-        change_datetime = (
-            datetime.fromisoformat(most_recent_change + "Z")
-            if most_recent_change
-            else None
-        )
-
-        if (
-            change_datetime
-            and datetime.now(tz=change_datetime.tzinfo) - change_datetime
-            >= idle_to_wait_for
-        ):
-            break
-    print("Finished.")  # noqa: T201
+    num_issues = get_num_issues(connection_supplier)
+    print(f"Finished with {num_issues} issues.")  # noqa: T201
+    return True
 
 
 if __name__ == "__main__":